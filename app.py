@@ -3,7 +3,12 @@ import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 import yfinance as yf
-from datetime import datetime
+import json
+import hashlib
+import threading
+from numpy.lib.stride_tricks import sliding_window_view
+from datetime import datetime, time
+from zoneinfo import ZoneInfo
 from google import genai
 
 # --- 1. CORE CONFIG ---
@@ -12,75 +17,209 @@ st.set_page_config(layout="wide", page_title="NQ & ES Quant Pro", initial_sideba
 if 'error_strikes' not in st.session_state:
     st.session_state.update({'error_strikes': 0, 'pattern_memory': []})
 
+# One persistent browser hook; alerts only send tiny payloads to it
+st.iframe("""<script>
+const P = window.parent;
+P.fireNotif = (t, b) => { if (P.Notification && P.Notification.permission === 'granted') new P.Notification(t, {body: b, icon: 'https://cdn-icons-png.flaticon.com/512/2464/2464402.png'}); };
+if (P.Notification && P.Notification.permission === 'default') P.Notification.requestPermission();
+</script>""", height="content")
+
 # --- 2. THE AI ENCODING SHIELD (Fixes Codec Error) ---
+@st.cache_resource(max_entries=16)
+def get_client(api_key):
+    """Builds the Gemini client once per key, shared across sessions"""
+    return genai.Client(api_key=api_key)
+
+GEMINI_MODELS = ["gemini-2.0-flash-exp", "gemini-2.5-flash"]
+
+@st.cache_resource
+def _report_cache():
+    """Process-wide ({(prompt, key hash, model): (ts, text)}, lock); st.cache_data can't memoize a stream"""
+    return {}, threading.Lock()
+
+def _ai(prompt_str, api_key, model_name):
+    """Streams the LLM answer; identical prompts within a 5m bar replay the cached text"""
+    (cache, lock), now = _report_cache(), datetime.now().timestamp()
+    k = (prompt_str, hashlib.sha256(api_key.encode()).hexdigest(), model_name)  # never keep raw keys around
+    with lock: hit = cache.get(k)
+    if hit and now - hit[0] < 300:
+        yield hit[1]; return
+    buf = []
+    for chunk in get_client(api_key).models.generate_content_stream(model=model_name, contents=prompt_str):
+        if chunk.text: buf.append(chunk.text); yield chunk.text
+    with lock:  # sessions share this dict across threads
+        for old in [c for c, (ts, _) in cache.items() if now - ts >= 300]: del cache[old]
+        cache[k] = (now, "".join(buf))
+
 def get_full_ai_report(label, last_p, dev, atr, rsi, vix, tnx, tech, defen, fin, conf, api_key):
-    """Sanitizes prompt to prevent ASCII codec errors"""
+    """Sanitizes prompt to prevent ASCII codec errors; yields the report as it streams"""
     try:
-        client = genai.Client(api_key=api_key)
-        
         # Build the prompt
         raw_prompt = f"Elite Report for {label} (${last_p:.2f}). Conf: {conf:.0f}%. VIX: {vix:.1f}. RSI: {rsi:.1f}. Sect: {tech:.2f}%. Verdict, Risk, Guidance."
         
         # Clean the prompt of non-ASCII characters (smart quotes, etc.)
         clean_prompt = raw_prompt.encode("ascii", "ignore").decode("ascii") 
         
-        resp = client.models.generate_content(model='gemini-2.0-flash-exp', contents=clean_prompt)
-        return resp.text
-    except Exception as e: return f"AI Error: {e}"
+        # Try the model that answered last first; if it fails, forget it and walk the rest of the chain
+        chosen = st.session_state.get('gemini_model')
+        for name in [chosen] + [m for m in GEMINI_MODELS if m != chosen] if chosen else GEMINI_MODELS:
+            stream = _ai(clean_prompt, api_key, name)
+            try: first = next(stream, "")
+            except Exception as e:
+                err = e; st.session_state.pop('gemini_model', None); continue
+            st.session_state.gemini_model = name
+            yield first; yield from stream
+            return
+        yield f"AI Error: {err}"
+    except Exception as e: yield f"AI Error: {e}"
 
 # --- 3. DATA & PATTERN MEMORY ---
+@st.cache_resource
+def chart_layout(kind):
+    """plotly_dark layouts resolved once per process; each figure copies its own"""
+    if kind == "main": return go.Layout(template="plotly_dark", xaxis=dict(type='date', tickformat='%H:%M<br>%b %d', rangeslider=dict(visible=False)), height=500)
+    if kind == "grid": return go.Layout(template="plotly_dark", margin=dict(l=5, r=5, t=5, b=5), height=250, xaxis_title="Slow", yaxis_title="Fast")
+    return go.Layout(template="plotly_dark", showlegend=False, margin=dict(l=5, r=5, t=5, b=5), height=150)
+
 def capture_pattern(df, reason):
     """Saves a snapshot for Visual Memory"""
-    fig = go.Figure(data=[go.Candlestick(x=df.index[-30:], open=df['Open'], high=df['High'], low=df['Low'], close=df['Close'])])
-    fig.update_layout(template="plotly_dark", showlegend=False, margin=dict(l=5, r=5, t=5, b=5), height=150)
-    snapshot = {"time": datetime.now().strftime("%H:%M"), "fig": fig, "reason": reason, "price": df['Close'].iloc[-1]}
+    tail = df.iloc[-30:]
+    fig = go.Figure(data=[go.Candlestick(x=tail.index, open=tail['Open'], high=tail['High'], low=tail['Low'], close=tail['Close'])], layout=chart_layout("snapshot"))
+    snapshot = {"time": datetime.now().strftime("%H:%M"), "fig": fig, "reason": reason, "price": tail['Close'].iloc[-1]}
     st.session_state.pattern_memory = ([snapshot] + st.session_state.pattern_memory)[:3]
 
+def fire_notifications(pending):
+    """Flushes a tick's (title, body) alerts in one iframe; JSON-escaped so symbols/quotes can't break out"""
+    payload = json.dumps(pending).replace("</", "<\\/")
+    st.iframe(f"<script>const F = window.parent.fireNotif; if (F) {payload}.forEach(([t, b]) => F(t, b));</script>", height="content")
+
+def rmean(a, w):
+    """Trailing w-bar mean with a NaN warm-up, like rolling(w).mean() minus the pandas dispatch"""
+    out = np.full(a.shape, np.nan)
+    if len(a) >= w: out[w - 1:] = sliding_window_view(a, w).mean(axis=1)
+    return out
+
+@st.cache_data(ttl=60, show_spinner=False, hash_funcs={pd.DataFrame: lambda d: (len(d), d.index[-1].value, *(float(d[k].iat[-1]) for k in ('High', 'Low', 'Close', 'Volume')))})
+def add_indicators(df):
+    """Single NumPy pass over OHLCV; VWAP, RSI and ATR attached in one assign"""
+    h, l, c, v = (df[k].to_numpy(np.float64) for k in ('High', 'Low', 'Close', 'Volume'))
+
+    # VWAP, fused on raw arrays (cumsums in float64 to avoid drift, stored as float32 for the chart)
+    vwap = (np.cumsum((h + l + c) * v / 3.0) / np.cumsum(v)).astype(np.float32)
+
+    # RSI (Wilder smoothing; zero-loss windows read 100 instead of NaN)
+    delta = np.diff(c, prepend=np.nan)
+    up, dn = np.where(delta > 0, delta, 0.0), np.where(delta < 0, -delta, 0.0)
+    up[0] = dn[0] = np.nan  # no prior close: seed the EWMs from the first real delta, not a fake 0
+    gain = pd.Series(up).ewm(alpha=1/14, adjust=False).mean().to_numpy()
+    loss = pd.Series(dn).ewm(alpha=1/14, adjust=False).mean().to_numpy()
+    rs = np.divide(gain, loss, out=np.full_like(gain, np.inf), where=loss != 0)
+
+    # ATR (true range; first bar has no prior close, so TR = H - L)
+    prev_c = np.roll(c, 1); prev_c[0] = c[0]
+    tr = np.maximum.reduce([h - l, np.abs(h - prev_c), np.abs(l - prev_c)])
+    atr = rmean(tr, 14)
+
+    return df.assign(VWAP=vwap, RSI=100 - 100 / (1 + rs), ATR=atr)
+
+def build_main_fig(symbol, df):
+    """Main chart figure; main_monitor keeps it per session until the bar changes"""
+    # Raw array views, all traces in one constructor (no add_trace re-validation of the figure)
+    # x as exchange wall-clock epoch ms: a numeric array serializes without per-stamp isoformat()
+    x = ((df.index.tz_localize(None) - pd.Timestamp(0)) // pd.Timedelta(1, 'ms')).to_numpy()
+    o, h, l, c, vwap = (df[k].to_numpy() for k in ('Open', 'High', 'Low', 'Close', 'VWAP'))
+    fig = go.Figure(data=[
+        go.Candlestick(x=x, open=o, high=h, low=l, close=c, name="Price"),
+        go.Scattergl(x=x, y=vwap, line=dict(color='cyan', dash='dash'), name="VWAP"),
+    ], layout=chart_layout("main"))
+    # Keep zoom/pan across refreshes of the same symbol, reset it when the asset changes
+    fig.update_layout(uirevision=symbol)
+    return fig
+
+def sma_grid(close, fast=range(5, 16), slow=range(18, 31)):
+    """Long-when-fast>slow return (%) for every SMA pair, from one cumsum broadcast over (fast, slow, T)"""
+    n, t = len(close), np.arange(len(close))
+    cs = np.concatenate([[0.0], np.cumsum(close)])
+    w = np.asarray([*fast, *slow])[:, None]
+    ma = np.where(t >= w - 1, (cs[t + 1] - cs[np.maximum(t + 1 - w, 0)]) / w, np.nan)
+    mf, ms = ma[:len(fast)][:, None, :], ma[len(fast):][None, :, :]
+    rets = np.diff(close) / close[:-1] if n > 1 else np.zeros(0)
+    pnl = ((mf > ms)[..., :-1] * rets).sum(axis=-1) * 100  # position set on bar t earns bar t+1
+    return pd.DataFrame(pnl, index=list(fast), columns=list(slow))
+
+def market_open():
+    """CME Globex hours for NQ/ES: Sun 18:00 - Fri 17:00 ET, daily 17:00-18:00 halt"""
+    now = datetime.now(ZoneInfo("America/New_York"))
+    wd, t = now.weekday(), now.time()
+    if wd == 5 or (wd == 6 and t < time(18)) or (wd == 4 and t >= time(17)): return False
+    return not (time(17) <= t < time(18))
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_batch():
+    """One batched 5m request shared by the pulse metrics and the main monitor (both assets are in it)"""
+    return yf.download(["XLK", "XLU", "XLF", "^TNX", "^VIX", "NQ=F", "ES=F"], period="2d", interval="5m", progress=False)
+
 @st.cache_data(ttl=60)
-def fetch_pulse(target):
+def fetch_pulse():
     try:
-        tickers = ["XLK", "XLU", "XLF", "^TNX", "^VIX", "NQ=F", "ES=F", target]
-        data = yf.download(tickers, period="2d", interval="5m", progress=False, multi_level_index=False)['Close']
-        vix, tnx = data["^VIX"].iloc[-1], data["^TNX"].iloc[-1]
-        rs_lead = ((data["NQ=F"] / data["ES=F"]).pct_change(5).iloc[-1]) * 1000
-        sects = {k: data[v].pct_change(20).iloc[-1]*100 for k, v in {"Tech": "XLK", "Def": "XLU", "Fin": "XLF"}.items()}
+        data = fetch_batch()['Close']
+        px = data.ffill()  # ETFs/yields go NaN outside RTH; read the last print
+
+        # Only the latest change is used, so read window endpoints instead of full pct_change series
+        vix, tnx = px["^VIX"].iloc[-1], px["^TNX"].iloc[-1]
+        rs = px["NQ=F"].to_numpy() / px["ES=F"].to_numpy()
+        rs_lead = (rs[-1] / rs[-6] - 1) * 1000
+        sects = {k: (px[v].iloc[-1] / px[v].iloc[-21] - 1)*100 for k, v in {"Tech": "XLK", "Def": "XLU", "Fin": "XLF"}.items()}
         return data, sects, vix, tnx, rs_lead, True
-    except: return None, {}, 0.0, 0.0, 0.0, False
+    except Exception: return None, {}, 0.0, 0.0, 0.0, False
 
 # --- 4. SIDEBAR ---
 st.sidebar.title("🛡️ Risk Management")
 key = st.sidebar.text_input("Gemini API Key:", type="password")
 target_sym = st.sidebar.selectbox("Asset", ["NQ=F", "ES=F"])
 
-data_p, sects, vix, tnx, rs_lead, is_clean = fetch_pulse(target_sym)
+data_p, sects, vix, tnx, rs_lead, is_clean = fetch_pulse()
 if not is_clean:
     st.session_state.error_strikes += 1
     if st.session_state.error_strikes >= 3:
-        st.cache_data.clear(); st.session_state.error_strikes = 0; st.rerun()
+        fetch_batch.clear(); fetch_pulse.clear(); st.session_state.error_strikes = 0; st.rerun()
 else: st.sidebar.success("✅ Data Integrity: 100%")
 
+with st.sidebar.expander("🧪 Backtest Grid"):
+    if st.toggle("SMA crossover sweep") and data_p is not None:
+        grid = sma_grid(data_p[target_sym].dropna().to_numpy(np.float64))
+        best_f, best_s = grid.stack().idxmax()
+        st.plotly_chart(go.Figure(go.Heatmap(z=grid.to_numpy(), x=grid.columns, y=grid.index, colorscale="RdYlGn", zmid=0), layout=chart_layout("grid")), width="stretch")
+        st.caption(f"Best: SMA {best_f}/{best_s} → {grid.loc[best_f, best_s]:+.2f}% over 2d of 5m bars")
+
 # --- 5. MAIN MONITOR ---
 st.title("🚀 NQ & ES Quantitative Trading Platform")
 
 @st.fragment(run_every=60)
 def main_monitor():
-    df = yf.download(target_sym, period="2d", interval="5m", progress=False)
-    if df.empty: return
+    st.session_state.report_inputs = None
+    if not market_open():
+        st.caption("🌙 Market closed — live feed paused until the next Globex session"); return
+    df = fetch_batch().xs(target_sym, axis=1, level=1).dropna(how='all')
+    if len(df) < 15:  # 14-bar ATR window + a prior close for RSI's first delta; shorter frames give NaN ATR / unseeded RSI
+        st.warning("⏳ Insufficient bars from Yahoo — waiting for the next tick"); return
 
-    # VWAP Calculation
-    tp = (df['High'] + df['Low'] + df['Close']) / 3
-    df['VWAP'] = (tp * df['Volume']).cumsum() / df['Volume'].cumsum()
+    # Reuse last tick's frame + figure while the bar hasn't changed (the forming bar's H/L/C/V all move)
+    last = df.iloc[-1].fillna(0)  # NaN != NaN would defeat the key
+    bar_key = (target_sym, df.index[-1], *(float(last[k]) for k in ('High', 'Low', 'Close', 'Volume')))
+    if st.session_state.get('bar_key') == bar_key:
+        df, fig = st.session_state.mon_df, st.session_state.mon_fig
+    else:
+        df = df.fillna({'Volume': 0}).astype({'Open': 'float32', 'High': 'float32', 'Low': 'float32', 'Close': 'float32', 'Volume': 'int32'})
+        df = add_indicators(df)
+        fig = build_main_fig(target_sym, df)
+        st.session_state.update({'bar_key': bar_key, 'mon_df': df, 'mon_fig': fig})
     
     # Corrected Indexing for Metrics
     last_p = float(df['Close'].iloc[-1])
-    last_vol = int(df['Volume'].iloc[-1])
     last_vwap = float(df['VWAP'].iloc[-1])
     dev = ((last_p - last_vwap) / last_vwap) * 100
-    
-    # RSI Calculation
-    delta = df['Close'].diff()
-    g, l = delta.where(delta > 0, 0).rolling(14).mean(), -delta.where(delta < 0, 0).rolling(14).mean()
-    rsi_val = float((100 - (100 / (1 + (g / l)))).iloc[-1])
+    rsi_val = float(df['RSI'].iloc[-1])
     conf = (max(0, 100-(vix*2.5))*0.4) + (rsi_val*0.3) + (min(100, 50+(rs_lead*10))*0.3)
 
     # UI Metrics
@@ -90,13 +229,21 @@ def main_monitor():
     m3.metric("RSI", f"{rsi_val:.1f}")
     
     # Charting
-    fig = go.Figure(data=[go.Candlestick(x=df.index, open=df['Open'], high=df['High'], low=df['Low'], close=df['Close'])])
-    fig.add_trace(go.Scatter(x=df.index, y=df['VWAP'], line=dict(color='cyan', dash='dash'), name="VWAP"))
-    fig.update_layout(template="plotly_dark", xaxis_rangeslider_visible=False, height=500)
     st.plotly_chart(fig, use_container_width=True)
 
     # Visual Memory UI
-    if last_vol > 1000: capture_pattern(df, "Volume Climax")
+    pending = []
+    # Scan every bar not yet seen in its final form, so a bar that crosses 1000 between ticks still alerts
+    # Both markers are per asset, so switching NQ=F/ES=F neither skips nor replays the other symbol's bars
+    scan_ts, climax_ts = st.session_state.setdefault('climax_scan_ts', {}), st.session_state.setdefault('climax_ts', {})
+    scanned = scan_ts.setdefault(target_sym, df.index[-2])
+    fresh = (df.index > scanned) & (df.index > climax_ts.get(target_sym, scanned))
+    hits = np.flatnonzero(fresh & (df['Volume'].to_numpy() > 1000))
+    scan_ts[target_sym] = max(scanned, df.index[-2])  # closed bars are final now; the forming bar is rescanned
+    if hits.size:
+        i = hits[-1]; climax_ts[target_sym] = df.index[i]
+        capture_pattern(df.iloc[:i + 1], "Volume Climax")
+        pending.append((f"{target_sym} Volume Climax", f"Vol {int(df['Volume'].iat[i]):,} @ ${float(df['Close'].iat[i]):.2f}"))
     if st.session_state.pattern_memory:
         st.divider(); st.subheader("🧠 Visual Pattern Memory")
         cols = st.columns(3)
@@ -104,15 +251,24 @@ def main_monitor():
             with cols[i]:
                 st.caption(f"🕒 {snap['time']} | {snap['reason']}")
                 st.plotly_chart(snap['fig'], use_container_width=True, key=f"mem_{i}")
+    if pending: fire_notifications(pending)
+
+    # Hand the latest metrics to the report fragment
+    st.session_state.report_inputs = {"last_p": last_p, "dev": dev, "atr": float(df['ATR'].iloc[-1]), "rsi": rsi_val, "conf": conf}
 
-    # Report Button
+# --- 6. AI REPORT ---
+@st.fragment
+def ai_section():
+    """Own fragment: Generate reruns only this block, not the fetch + chart"""
     if st.button("🧠 Generate Full Prediction Report", use_container_width=True, type="primary"):
+        # Read inputs at click time: monitor ticks rerun only main_monitor, never this fragment
+        inp = st.session_state.get('report_inputs')
         if not key: st.error("Add Gemini Key")
+        elif inp is None: st.warning("⏳ No live bars yet (market closed or feed short) — try again once the monitor updates")
         else:
             with st.spinner("Analyzing..."):
-                atr = float((df['High'].rolling(14).max() - df['Low'].rolling(14).min()).iloc[-1])
-                report = get_full_ai_report(target_sym, last_p, dev, atr, rsi_val, vix, tnx, sects['Tech'], sects['Def'], sects['Fin'], conf, key)
                 st.info("### 🎯 AI Quantitative Prediction Report")
-                st.markdown(report)
+                st.write_stream(get_full_ai_report(target_sym, inp['last_p'], inp['dev'], inp['atr'], inp['rsi'], vix, tnx, sects['Tech'], sects['Def'], sects['Fin'], inp['conf'], key))
 
-main_monitor()
\ No newline at end of file
+main_monitor()
+ai_section()
\ No newline at end of file